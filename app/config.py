@@ -1,12 +1,7 @@
-import os
 import logging
+import os
+from functools import cached_property, lru_cache
 from pydantic_settings import BaseSettings
-from pathlib import Path
-from dotenv import load_dotenv
-
-# Carrega variáveis do .env se existir
-env_path = Path('.') / '.env'
-load_dotenv(dotenv_path=env_path)
 
 class Settings(BaseSettings):
     DATABASE_URL: str
@@ -19,18 +14,25 @@ class Settings(BaseSettings):
     CONTEXT_MESSAGE_COUNT: int = 6
     LOG_LEVEL: str = "INFO"
 
-    _system_prompt_cache: str | None = None
+    # Fila de tarefas (arq). Sem REDIS_URL o webhook cai no BackgroundTasks in-process.
+    REDIS_URL: str | None = None
 
-    @property
+    # Pool de conexões do banco (ajustável por worker via env no Render)
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 30
+    DB_POOL_TIMEOUT: int = 30
+    DB_POOL_RECYCLE: int = 1800
+
+    @cached_property
     def system_prompt(self) -> str:
-        if self._system_prompt_cache is None:
-            try:
-                with open(self.SYSTEM_PROMPT_PATH, 'r', encoding='utf-8') as f:
-                    self._system_prompt_cache = f.read().strip()
-            except Exception as e:
-                logging.error(f"ERRO ao ler o arquivo de prompt: {e}. Usando prompt padrão.", exc_info=True)
-                self._system_prompt_cache = "Você é uma assistente virtual."
-        return self._system_prompt_cache
+        # cached_property garante UMA leitura do arquivo por processo;
+        # atributos privados "soltos" não sobrevivem à validação do Pydantic v2.
+        try:
+            with open(self.SYSTEM_PROMPT_PATH, 'r', encoding='utf-8') as f:
+                return f.read().strip()
+        except Exception as e:
+            logging.error("ERRO ao ler o arquivo de prompt: %s. Usando prompt padrão.", e, exc_info=True)
+            return "Você é uma assistente virtual."
 
     @property
     def zapi_send_message_url(self) -> str:
@@ -43,7 +45,16 @@ class Settings(BaseSettings):
         env_file_encoding = 'utf-8'
         extra = 'ignore'
 
-settings = Settings()
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Retorna a instância única de Settings (construída uma vez por processo)."""
+    # LOAD_DOTENV=0 (produção: Render injeta as env vars direto) pula
+    # inclusive o stat()/parse do .env feito pelo pydantic-settings
+    if os.getenv("LOAD_DOTENV", "1") == "0":
+        return Settings(_env_file=None)
+    return Settings()
+
+settings = get_settings()
 
 # Configuração básica de Logging
 logging.basicConfig(
@@ -54,6 +65,6 @@ logging.basicConfig(
 logger = logging.getLogger("DraAnaIA_Minimal")
 
 logger.info("Configurações carregadas.")
-logger.debug(f"DB URL Configurada: {'Sim' if settings.DATABASE_URL else 'Não'}")
-logger.debug(f"OpenRouter Model: {settings.OPENROUTER_MODEL}")
-logger.debug(f"Z-API Instance: {settings.ZAPI_INSTANCE_ID}")
\ No newline at end of file
+logger.debug("DB URL Configurada: %s", "Sim" if settings.DATABASE_URL else "Não")
+logger.debug("OpenRouter Model: %s", settings.OPENROUTER_MODEL)
+logger.debug("Z-API Instance: %s", settings.ZAPI_INSTANCE_ID)
\ No newline at end of file
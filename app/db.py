@@ -1,7 +1,9 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
-from app.config import settings, logger
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base
+from app.config import get_settings, logger
 
+settings = get_settings()
 DATABASE_URL = settings.DATABASE_URL
 Base = declarative_base()
 engine = None
@@ -9,45 +11,75 @@ AsyncSessionFactory = None
 
 try:
     if DATABASE_URL:
-        engine = create_async_engine(DATABASE_URL, echo=False, future=True)
-        AsyncSessionFactory = sessionmaker(
-            engine, class_=AsyncSession, expire_on_commit=False
+        engine = create_async_engine(
+            DATABASE_URL,
+            echo=False,
+            future=True,
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+            pool_pre_ping=True,
+            pool_use_lifo=True,  # Reusa conexões "quentes" primeiro
+        )
+        # async_sessionmaker (2.0) evita o shim síncrono do sessionmaker legado;
+        # autoflush desligado: as escritas do fluxo são INSERTs explícitos
+        AsyncSessionFactory = async_sessionmaker(
+            engine, expire_on_commit=False, autoflush=False
         )
         logger.info("Motor SQLAlchemy e Fábrica de Sessão Async criados.")
     else:
         logger.error("DATABASE_URL não definida nas configurações!")
 
 except Exception as e:
-    logger.error(f"Falha ao inicializar conexão com o banco de dados: {e}", exc_info=True)
+    logger.error("Falha ao inicializar conexão com o banco de dados: %s", e, exc_info=True)
     engine = None
     AsyncSessionFactory = None
 
-async def get_db() -> AsyncSession:
-    """Dependência FastAPI para obter uma sessão de banco de dados."""
-    if AsyncSessionFactory is None:
-        logger.error("Fábrica de Sessão não inicializada.")
-        raise RuntimeError("Conexão com DB não estabelecida.")
+# Migrações idempotentes para bancos criados antes destas mudanças de schema;
+# create_all (checkfirst) nunca altera tipos/tabelas que já existem.
+# Bancos novos já nascem certos: os DO-blocks engolem o "valor não existe".
+_MIGRATIONS = (
+    # Defaults server-side de id em tabelas criadas com o antigo uuid.uuid4
+    # do lado Python (sem eles o INSERT passa a violar o NOT NULL da PK)
+    "ALTER TABLE users ALTER COLUMN id SET DEFAULT gen_random_uuid()",
+    "ALTER TABLE chat_history ALTER COLUMN id SET DEFAULT gen_random_uuid()",
+    """
+    DO $$
+    BEGIN
+        ALTER TYPE sender_type_enum RENAME VALUE 'USER' TO 'user';
+    EXCEPTION WHEN undefined_object OR invalid_parameter_value THEN NULL;
+    END $$
+    """,
+    """
+    DO $$
+    BEGIN
+        ALTER TYPE sender_type_enum RENAME VALUE 'AI' TO 'ai';
+    EXCEPTION WHEN undefined_object OR invalid_parameter_value THEN NULL;
+    END $$
+    """,
+)
 
-    async with AsyncSessionFactory() as session:
+async def init_db():
+    """Cria as tabelas (se não existirem) e aplica migrações leves."""
+    if engine:
+        # pgcrypto fornece gen_random_uuid() em Postgres < 13. Best-effort em
+        # transação própria: sem privilégio para extensões (Postgres gerenciado),
+        # a falha não pode derrubar o create_all junto.
         try:
-            yield session
-            await session.commit()
+            async with engine.begin() as conn:
+                await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pgcrypto"))
         except Exception as e:
-            logger.error(f"Erro durante transação da sessão: {e}", exc_info=True)
-            await session.rollback()
-            raise
-        finally:
-            await session.close()
+            logger.warning("Extensão pgcrypto não criada (desnecessária em PG13+): %s", e)
 
-async def init_db():
-    """Cria as tabelas (se não existirem)."""
-    if engine:
         async with engine.begin() as conn:
             try:
                 # await conn.run_sync(Base.metadata.drop_all) # CUIDADO!
                 await conn.run_sync(Base.metadata.create_all)
+                for stmt in _MIGRATIONS:
+                    await conn.execute(text(stmt))
                 logger.info("Tabelas do banco de dados verificadas/criadas.")
             except Exception as e:
-                logger.error(f"Falha ao inicializar tabelas do DB: {e}", exc_info=True)
+                logger.error("Falha ao inicializar tabelas do DB: %s", e, exc_info=True)
     else:
         logger.error("Motor do DB não inicializado, impossível criar tabelas.")
\ No newline at end of file
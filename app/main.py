@@ -1,21 +1,61 @@
-from fastapi import FastAPI, Depends, HTTPException, Request, BackgroundTasks, Response
+from fastapi import FastAPI, HTTPException, Request, BackgroundTasks, Response
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import desc
+from sqlalchemy import String, cast, desc, func, insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from arq.connections import RedisSettings, create_pool
 from contextlib import asynccontextmanager
+from typing import Optional
 import httpx
+import logging
+import orjson
+import re
 import uuid
 
 from app import db, models, schemas
-from app.config import settings, logger
+from app.config import get_settings, logger
+
+settings = get_settings()
+
+# Mensagem de sistema pré-montada uma vez por processo; evita revalidar
+# o prompt (potencialmente grande) via Pydantic a cada chamada à IA
+SYSTEM_MESSAGE = {"role": "system", "content": settings.system_prompt}
+
+_NON_DIGIT = re.compile(r"\D")
+
+def normalize_phone(phone: str) -> str:
+    """Remove não dígitos e garante o prefixo 55 para números BR curtos."""
+    clean_phone = _NON_DIGIT.sub("", phone)
+    if len(clean_phone) <= 11 and not clean_phone.startswith("55"):
+        clean_phone = "55" + clean_phone
+    return clean_phone
 
 # --- Ciclo de Vida da Aplicação ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Iniciando aplicação...")
+    # Aquece o cache do prompt de sistema (leitura única do arquivo)
+    logger.info("Prompt de sistema carregado (%s chars).", len(settings.system_prompt))
     await db.init_db() # Cria tabelas se não existirem
+    # Cliente HTTP compartilhado: evita handshake DNS+TCP+TLS por requisição
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(60.0),
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+    )
+    # Fila arq (opcional): com REDIS_URL o processamento sai do processo web
+    if settings.REDIS_URL:
+        app.state.arq = await create_pool(RedisSettings.from_dsn(settings.REDIS_URL))
+        logger.info("Fila arq conectada ao Redis.")
+    else:
+        app.state.arq = None
+        logger.info("REDIS_URL ausente; usando BackgroundTasks in-process.")
     yield
     logger.info("Encerrando aplicação...")
+    if app.state.arq:
+        await app.state.arq.aclose()
+    await app.state.http.aclose()
     if db.engine:
         await db.engine.dispose()
 
@@ -23,174 +63,198 @@ app = FastAPI(
     title="Dra. Ana IA - Minimal",
     description="Versão simplificada para testes de integração.",
     version="0.1.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # --- Funções Auxiliares (Podem ficar aqui ou em crud.py simplificado) ---
 
 async def get_or_create_user(session: AsyncSession, phone: str, name: Optional[str] = None) -> models.User:
-    """Busca usuário pelo telefone ou cria um novo."""
-    result = await session.execute(select(models.User).filter(models.User.phone_number == phone))
-    user = result.scalars().first()
-
-    if user:
-        # Atualiza o nome se veio diferente ou se estava vazio
-        if name and (not user.name or user.name != name):
-            user.name = name
-            session.add(user)
-            await session.flush()
-            await session.refresh(user)
-            logger.info(f"Nome do usuário {phone} atualizado para '{name}'.")
-        return user
-    else:
-        logger.info(f"Criando novo usuário para {phone}.")
-        new_user = models.User(phone_number=phone, name=name)
-        session.add(new_user)
-        await session.flush() # Garante que o ID seja gerado
-        await session.refresh(new_user)
-        return new_user
-
-async def save_chat_message(session: AsyncSession, user_id: uuid.UUID, message: str, sender: models.SenderTypeEnum):
-    """Salva uma mensagem no histórico."""
-    chat_entry = models.ChatHistory(
-        user_id=user_id,
-        message=message,
-        sender_type=sender
-    )
-    session.add(chat_entry)
-    await session.flush()
-    logger.debug(f"Mensagem de '{sender.value}' salva para usuário ID {user_id}")
-
-async def get_chat_history(session: AsyncSession, user_id: uuid.UUID, limit: int) -> list[models.ChatHistory]:
-    """Recupera as últimas N mensagens em ordem cronológica."""
-    result = await session.execute(
-        select(models.ChatHistory)
+    """Busca ou cria o usuário com um UPSERT (um único roundtrip ao banco)."""
+    stmt = pg_insert(models.User).values(phone_number=phone, name=name)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.User.phone_number],
+        set_={
+            # COALESCE preserva o nome existente quando o webhook não traz um
+            "name": func.coalesce(stmt.excluded.name, models.User.name),
+            "updated_at": func.now(),
+        },
+    ).returning(models.User)
+    result = await session.execute(stmt)
+    user = result.scalars().one()
+    logger.debug("Usuário %s obtido/criado via UPSERT (ID %s).", phone, user.id)
+    return user
+
+async def save_chat_messages(session: AsyncSession, rows: list[dict]):
+    """Insere uma ou mais mensagens no histórico em um único executemany."""
+    if not rows:
+        return
+    await session.execute(insert(models.ChatHistory), rows)
+    logger.debug("%s mensagem(ns) salvas em lote no histórico.", len(rows))
+
+async def get_chat_history(session: AsyncSession, user_id: uuid.UUID, limit: int) -> list[tuple[str, str]]:
+    """Recupera as últimas N mensagens como tuplas (message, sender_type), em ordem cronológica."""
+    # Subquery pega as N mais recentes; a query externa reordena no servidor
+    # (antigo -> novo), evitando o slice [::-1] e a hidratação de objetos ORM.
+    # sender_type vem como string crua (cast), sem reinstanciar o Enum por linha.
+    latest = (
+        select(
+            models.ChatHistory.message,
+            cast(models.ChatHistory.sender_type, String).label("sender_type"),
+            models.ChatHistory.timestamp,
+        )
         .filter(models.ChatHistory.user_id == user_id)
         .order_by(desc(models.ChatHistory.timestamp))
         .limit(limit)
+        .subquery()
     )
-    messages = result.scalars().all()
-    return messages[::-1] # Inverte para ordem cronológica (antigo -> novo)
+    result = await session.execute(
+        select(latest.c.message, latest.c.sender_type).order_by(latest.c.timestamp)
+    )
+    return result.all()
 
-async def call_openrouter(history: list[schemas.OpenRouterMessage]) -> Optional[str]:
+async def call_openrouter(history: list[dict], client: httpx.AsyncClient) -> Optional[str]:
     """Chama a API OpenRouter para gerar resposta."""
-    payload = schemas.OpenRouterRequest(
-        model=settings.OPENROUTER_MODEL,
-        messages=[schemas.OpenRouterMessage(role="system", content=settings.system_prompt)] + history
-    )
+    # Payload como dicts simples: o histórico já sai validado do banco,
+    # então a validação Pydantic por mensagem seria trabalho redundante
+    payload = {
+        "model": settings.OPENROUTER_MODEL,
+        "messages": [SYSTEM_MESSAGE, *history],
+        "max_tokens": 1000,
+        "stream": True,
+    }
     headers = {
         "Authorization": f"Bearer {settings.OPENROUTER_API_KEY}",
         "Content-Type": "application/json"
     }
     url = "https://openrouter.ai/api/v1/chat/completions"
 
-    logger.debug(f"Enviando para OpenRouter: Model={payload.model}, Mensagens={len(payload.messages)}")
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        try:
-            response = await client.post(url, json=payload.model_dump(), headers=headers)
-            response.raise_for_status()
-            data = response.json()
-            parsed_response = schemas.OpenRouterResponse.model_validate(data) # Pydantic v2
-            # parsed_response = schemas.OpenRouterResponse.parse_obj(data) # Pydantic v1
-
-            if parsed_response.choices:
-                ai_message = parsed_response.choices[0].message.content
-                logger.info("Resposta da IA recebida do OpenRouter.")
-                return ai_message.strip()
-            else:
-                logger.warning("OpenRouter respondeu sem 'choices'.")
+    logger.debug("Enviando para OpenRouter: Model=%s, Mensagens=%s", payload["model"], len(payload["messages"]))
+    try:
+        # Streaming SSE: os tokens chegam conforme são gerados, em vez de
+        # esperar o corpo completo (5-20s) para começar a ler
+        chunks: list[str] = []
+        async with client.stream("POST", url, content=orjson.dumps(payload), headers=headers) as response:
+            if response.status_code >= 400:
+                # Ler o corpo ANTES do stream fechar; fora do async with seria StreamClosed
+                body = await response.aread()
+                logger.error("Erro HTTP OpenRouter: Status %s, Response: %s", response.status_code, body.decode(errors="replace"))
                 return None
-        except httpx.HTTPStatusError as e:
-            logger.error(f"Erro HTTP OpenRouter: Status {e.response.status_code}, Response: {e.response.text}", exc_info=True)
-            return None
-        except Exception as e:
-            logger.error(f"Erro ao chamar ou processar OpenRouter: {e}", exc_info=True)
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                data = line[6:]
+                if data == "[DONE]":
+                    break
+                try:
+                    delta = orjson.loads(data)["choices"][0].get("delta", {}).get("content")
+                except (orjson.JSONDecodeError, LookupError):
+                    continue  # comentários/keep-alives do SSE
+                if delta:
+                    chunks.append(delta)
+
+        if chunks:
+            logger.info("Resposta da IA recebida do OpenRouter (stream).")
+            return "".join(chunks).strip()
+        else:
+            logger.warning("OpenRouter não retornou conteúdo no stream.")
             return None
+    except Exception as e:
+        logger.error("Erro ao chamar ou processar OpenRouter: %s", e, exc_info=True)
+        return None
 
-async def send_zapi_message(phone: str, message: str):
+async def send_zapi_message(phone: str, message: str, client: httpx.AsyncClient):
     """Envia mensagem via Z-API."""
     if not message:
-        logger.warning(f"Tentativa de enviar mensagem vazia para {phone}.")
+        logger.warning("Tentativa de enviar mensagem vazia para %s.", phone)
         return
-    # Limpeza básica do número (remover não dígitos, garantir 55 se for número BR curto)
-    clean_phone = "".join(filter(str.isdigit, phone))
-    if len(clean_phone) <= 11 and not clean_phone.startswith("55"):
-        clean_phone = "55" + clean_phone
+    # O número já chega normalizado do webhook (normalize_phone)
+    clean_phone = phone
 
     payload = {"phone": clean_phone, "message": message}
     url = settings.zapi_send_message_url
     headers = {"Content-Type": "application/json"}
 
-    logger.info(f"Enviando mensagem Z-API para {clean_phone}")
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.post(url, json=payload, headers=headers)
-            response.raise_for_status()
-            logger.info(f"Mensagem enviada com sucesso para {clean_phone}")
-            logger.debug(f"Z-API Response: {response.json()}")
-        except httpx.HTTPStatusError as e:
-            logger.error(f"Erro HTTP Z-API: Status {e.response.status_code}, Response: {e.response.text}", exc_info=True)
-        except Exception as e:
-            logger.error(f"Erro ao enviar mensagem Z-API: {e}", exc_info=True)
-
-
-# --- Processamento da Mensagem (Tarefa de Fundo) ---
-async def process_incoming_message(db_session: AsyncSession, phone: str, name: Optional[str], user_message: str):
-    """Orquestra o fluxo de processamento."""
+    logger.info("Enviando mensagem Z-API para %s", clean_phone)
     try:
-        logger.info(f"[BG Task] Iniciando processamento para {phone}")
-        user = await get_or_create_user(db_session, phone, name)
+        response = await client.post(url, json=payload, headers=headers)
+        response.raise_for_status()
+        logger.info("Mensagem enviada com sucesso para %s", clean_phone)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Z-API Response: %s", response.json())
+    except httpx.HTTPStatusError as e:
+        logger.error("Erro HTTP Z-API: Status %s, Response: %s", e.response.status_code, e.response.text, exc_info=True)
+    except Exception as e:
+        logger.error("Erro ao enviar mensagem Z-API: %s", e, exc_info=True)
 
-        await save_chat_message(db_session, user.id, user_message, models.SenderTypeEnum.USER)
 
-        # Recuperar histórico recente
-        history_db = await get_chat_history(db_session, user.id, settings.CONTEXT_MESSAGE_COUNT)
-        history_for_ai = [
-            schemas.OpenRouterMessage(
-                role="assistant" if msg.sender_type == models.SenderTypeEnum.AI else "user",
-                content=msg.message
-            )
-            for msg in history_db # Inclui a mensagem atual do usuário que acabamos de salvar
-        ]
+# --- Processamento da Mensagem (Tarefa de Fundo) ---
+async def process_incoming_message(http_client: httpx.AsyncClient, phone: str, name: Optional[str], user_message: str):
+    """Orquestra o fluxo de processamento.
 
-        # Chamar IA
-        ai_response = await call_openrouter(history_for_ai)
+    Abre a própria sessão de DB: uma sessão com escopo de request já
+    estaria fechada pelo FastAPI quando a tarefa de fundo executa.
+    """
+    try:
+        logger.info("[BG Task] Iniciando processamento para %s", phone)
+        if db.AsyncSessionFactory is None:
+            raise RuntimeError("Conexão com DB não estabelecida.")
+
+        async with db.AsyncSessionFactory() as db_session:
+            user = await get_or_create_user(db_session, phone, name)
+
+            # Recuperar histórico recente; a mensagem atual ainda não foi gravada,
+            # então entra no fim da lista (gravação em lote após a resposta da IA)
+            history_db = await get_chat_history(db_session, user.id, max(settings.CONTEXT_MESSAGE_COUNT - 1, 0))
+            history_for_ai = [
+                {
+                    "role": "assistant" if sender_type == models.SenderTypeEnum.AI.value else "user",
+                    "content": message,
+                }
+                for message, sender_type in history_db
+            ]
+            history_for_ai.append({"role": "user", "content": user_message})
+
+            # Chamar IA
+            ai_response = await call_openrouter(history_for_ai, http_client)
+
+            # Mensagem do usuário + resposta da IA em um único INSERT
+            chat_rows = [{"user_id": user.id, "message": user_message, "sender_type": models.SenderTypeEnum.USER}]
+            if ai_response:
+                chat_rows.append({"user_id": user.id, "message": ai_response, "sender_type": models.SenderTypeEnum.AI})
+            await save_chat_messages(db_session, chat_rows)
+
+            await db_session.commit()
 
         if ai_response:
-            await save_chat_message(db_session, user.id, ai_response, models.SenderTypeEnum.AI)
-            await send_zapi_message(phone, ai_response)
+            await send_zapi_message(phone, ai_response, http_client)
         else:
-            logger.error(f"[BG Task] Falha ao obter resposta da IA para {phone}. Enviando msg de erro.")
-            await send_zapi_message(phone, "Desculpe, não consegui processar sua solicitação no momento. 🥺 Tente novamente mais tarde.")
+            logger.error("[BG Task] Falha ao obter resposta da IA para %s. Enviando msg de erro.", phone)
+            await send_zapi_message(phone, "Desculpe, não consegui processar sua solicitação no momento. 🥺 Tente novamente mais tarde.", http_client)
 
-        # Commit explícito aqui, pois get_db fará commit/rollback fora desta função
-        # Na verdade, o commit é feito pelo context manager do get_db ao final do request
-        # await db_session.commit() # Não é necessário aqui se get_db gerencia
-
-        logger.info(f"[BG Task] Processamento concluído para {phone}")
+        logger.info("[BG Task] Processamento concluído para %s", phone)
 
     except Exception as e:
-        logger.error(f"[BG Task] Erro fatal no processamento para {phone}: {e}", exc_info=True)
+        logger.error("[BG Task] Erro fatal no processamento para %s: %s", phone, e, exc_info=True)
         # Tentar enviar mensagem de erro genérica
         try:
-            await send_zapi_message(phone, "Ocorreu um erro interno. Por favor, tente novamente mais tarde.")
+            await send_zapi_message(phone, "Ocorreu um erro interno. Por favor, tente novamente mais tarde.", http_client)
         except Exception as send_err:
-             logger.error(f"[BG Task] Falha ao enviar mensagem de erro final para {phone}: {send_err}")
-        # O rollback será feito pelo context manager do get_db
+             logger.error("[BG Task] Falha ao enviar mensagem de erro final para %s: %s", phone, send_err)
 
 # --- Endpoint Webhook Z-API ---
 @app.post("/webhook/zapi", status_code=200)
 async def handle_zapi_webhook(
     request: Request,
     background_tasks: BackgroundTasks,
-    db_session: AsyncSession = Depends(db.get_db) # Obtém sessão do DB
 ):
     """Recebe webhook da Z-API e dispara processamento em background."""
     try:
-        payload = await request.json()
-        logger.debug(f"Webhook Z-API recebido: {payload}")
+        # orjson (Rust/SIMD) em vez do json.loads stdlib usado por request.json()
+        payload = orjson.loads(await request.body())
+        logger.debug("Webhook Z-API recebido: %s", payload)
     except Exception as e:
-        logger.error(f"Erro ao ler JSON do webhook: {e}", exc_info=True)
+        logger.error("Erro ao ler JSON do webhook: %s", e, exc_info=True)
         raise HTTPException(status_code=400, detail="Payload inválido.")
 
     try:
@@ -206,7 +270,8 @@ async def handle_zapi_webhook(
             logger.info("Webhook sem mensagem de texto ignorado.")
             return {"status": "ignored_no_text"}
 
-        phone = webhook_data.phone
+        # Normaliza o telefone UMA vez; tarefa de fundo e Z-API usam o valor limpo
+        phone = normalize_phone(webhook_data.phone)
         name = webhook_data.senderName
         user_message = webhook_data.message.text.strip()
 
@@ -215,14 +280,17 @@ async def handle_zapi_webhook(
              return {"status": "ignored_empty_text"}
 
 
-        # Adiciona tarefa de fundo para processar
-        background_tasks.add_task(process_incoming_message, db_session, phone, name, user_message)
+        # Enfileira no worker arq; sem Redis, cai no BackgroundTasks in-process
+        if request.app.state.arq:
+            await request.app.state.arq.enqueue_job("process_message", phone, name, user_message)
+        else:
+            background_tasks.add_task(process_incoming_message, request.app.state.http, phone, name, user_message)
 
-        logger.info(f"Mensagem de {phone} adicionada à fila de processamento.")
+        logger.info("Mensagem de %s adicionada à fila de processamento.", phone)
         return {"status": "received"} # Resposta rápida para Z-API
 
     except Exception as e: # Erro na validação Pydantic ou outra lógica aqui
-        logger.error(f"Erro ao processar payload do webhook: {e}", exc_info=True)
+        logger.error("Erro ao processar payload do webhook: %s", e, exc_info=True)
         # Não levanta HTTPException aqui para evitar que Z-API tente reenviar indefinidamente
         # Apenas loga o erro e retorna OK.
         return {"status": "processing_error"}
@@ -238,44 +306,4 @@ async def health_check():
 # if __name__ == "__main__":
 #     import uvicorn
 #     uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
-# Comentado pois Gunicorn/Render usará o comando no Procfile
-
-import os
-import httpx
-from app.config import settings
-
-async def call_openrouter(messages: list[dict]) -> str:
-    """
-    Envia mensagens para a IA da OpenRouter com base no histórico e no prompt.
-    """
-    try:
-        prompt_path = os.path.join(os.path.dirname(__file__), "../prompt/system_prompt.txt")
-        with open(prompt_path, "r", encoding="utf-8") as f:
-            system_prompt = f.read().strip()
-
-        chat_messages = [{"role": "system", "content": system_prompt}] + [
-            {"role": m.role, "content": m.content} for m in messages
-        ]
-
-        headers = {
-            "Authorization": f"Bearer {settings.OPENROUTER_API_KEY}",
-            "HTTP-Referer": "https://draana.whatsapp",
-            "Content-Type": "application/json"
-        }
-
-        body = {
-            "model": "google/gemini-2.0-flash-001",
-            "messages": chat_messages,
-            "temperature": 0.7,
-            "max_tokens": 1000
-        }
-
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=body)
-            response.raise_for_status()
-            data = response.json()
-            return data["choices"][0]["message"]["content"].strip()
-
-    except Exception as e:
-        settings.logger.error(f"Erro ao chamar OpenRouter: {e}", exc_info=True)
-        return None
\ No newline at end of file
+# Comentado pois Gunicorn/Render usará o comando no Procfile
\ No newline at end of file
@@ -1,7 +1,7 @@
 import enum
-import uuid
 from sqlalchemy import (
-    Column, Integer, String, DateTime, Text, Enum as SQLEnum, ForeignKey
+    Column, Integer, String, DateTime, Text, Enum as SQLEnum, ForeignKey,
+    Index, text
 )
 from sqlalchemy.dialects.postgresql import UUID as PG_UUID
 from sqlalchemy.sql import func
@@ -12,7 +12,8 @@ from app.db import Base
 class User(Base):
     __tablename__ = "users"
 
-    id = Column(PG_UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    # UUID gerado no servidor (gen_random_uuid), sem CSPRNG em Python por INSERT
+    id = Column(PG_UUID(as_uuid=True), primary_key=True, server_default=text("gen_random_uuid()"))
     phone_number = Column(String, unique=True, index=True, nullable=False)
     name = Column(String, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -27,12 +28,28 @@ class SenderTypeEnum(str, enum.Enum): # Herdando de str para facilitar serializa
 class ChatHistory(Base):
     __tablename__ = "chat_history"
 
-    id = Column(PG_UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = Column(PG_UUID(as_uuid=True), primary_key=True, server_default=text("gen_random_uuid()"))
     # Usando ForeignKey para ID do usuário em vez de telefone diretamente
     # Isso é geralmente melhor para integridade referencial
-    user_id = Column(PG_UUID(as_uuid=True), ForeignKey("users.id"), nullable=False, index=True)
+    user_id = Column(PG_UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
     message = Column(Text, nullable=False)
-    sender_type = Column(SQLEnum(SenderTypeEnum, name="sender_type_enum"), nullable=False) # Adiciona nome ao Enum
-    timestamp = Column(DateTime(timezone=True), server_default=func.now(), index=True)
-
-    user = relationship("User", back_populates="chat_history")
\ No newline at end of file
+    # values_callable grava os valores ("user"/"ai") no enum nativo do Postgres,
+    # em vez dos nomes dos membros, casando com o que o código compara
+    sender_type = Column(
+        SQLEnum(
+            SenderTypeEnum,
+            name="sender_type_enum",
+            native_enum=True,
+            values_callable=lambda e: [m.value for m in e],
+        ),
+        nullable=False,
+    )
+    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+
+    user = relationship("User", back_populates="chat_history")
+
+    # Índice composto cobre o WHERE user_id=? ORDER BY timestamp DESC LIMIT N
+    # do get_chat_history; os índices simples em user_id/timestamp eram redundantes.
+    __table_args__ = (
+        Index("ix_chathistory_user_ts_desc", "user_id", text("timestamp DESC")),
+    )
\ No newline at end of file
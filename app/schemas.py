@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Optional
 import datetime
 import uuid
 from app.models import SenderTypeEnum # Importa o Enum
@@ -27,19 +27,5 @@ class ZapiWebhookPayload(BaseModel):
     message: Optional[ZapiMessagePayload] = None
     isGroupMessage: Optional[bool] = False
 
-# --- Schemas para OpenRouter Simplificado ---
-class OpenRouterMessage(BaseModel):
-    role: str # "system", "user", "assistant"
-    content: str
-
-class OpenRouterRequest(BaseModel):
-    model: str
-    messages: List[OpenRouterMessage]
-    max_tokens: int = 1000 # Limite padrão
-
-class OpenRouterChoice(BaseModel):
-    message: OpenRouterMessage
-
-class OpenRouterResponse(BaseModel):
-    choices: List[OpenRouterChoice]
-    # Não precisamos do 'usage' para esta versão mínima
\ No newline at end of file
+# Os schemas OpenRouter* foram removidos: requisição e resposta (SSE) da IA
+# são montadas/lidas como dicts simples em app/main.py.
\ No newline at end of file
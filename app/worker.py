@@ -0,0 +1,37 @@
+import httpx
+from arq.connections import RedisSettings
+
+from app.config import get_settings, logger
+from app.main import process_incoming_message
+
+settings = get_settings()
+
+# Worker arq: processa as mensagens fora do processo web, para que uma
+# chamada lenta à IA não dispute o event loop com novos webhooks.
+# Rodar com: arq app.worker.WorkerSettings
+
+async def startup(ctx: dict):
+    logger.info("Worker arq iniciando...")
+    ctx["http"] = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(60.0),
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+    )
+
+async def shutdown(ctx: dict):
+    logger.info("Worker arq encerrando...")
+    await ctx["http"].aclose()
+
+async def process_message(ctx: dict, phone: str, name: str | None, user_message: str):
+    """Tarefa arq: delega para o mesmo pipeline usado pelo fallback in-process."""
+    await process_incoming_message(ctx["http"], phone, name, user_message)
+
+class WorkerSettings:
+    functions = [process_message]
+    on_startup = startup
+    on_shutdown = shutdown
+    redis_settings = (
+        RedisSettings.from_dsn(settings.REDIS_URL)
+        if settings.REDIS_URL
+        else RedisSettings()
+    )